@@ -2,11 +2,18 @@
 Main FastAPI application for the PDF Chatbot with RAG capabilities.
 """
 
+import asyncio
+import hashlib
 import logging
 import os
+import time
+import aiofiles
+import orjson
+from datetime import datetime
+from functools import lru_cache
 from fastapi import FastAPI, HTTPException, UploadFile, File, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from contextlib import asynccontextmanager
 
 from .models import (
@@ -16,19 +23,50 @@ from .models import (
 from .services.pdf_service import PDFService
 from .services.chat_service import ChatService
 from .utils.config import settings
+from .utils.shared_state import SharedState
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+API_VERSION = "2.0.0"
+
+# How often old uploads are cleaned up
+CLEANUP_INTERVAL_SECONDS = 3600
+
+# Size of each read when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+
 # Global service instances
 pdf_service: PDFService = None
 chat_service: ChatService = None
+shared_state: SharedState = None
+
+def sync_shared_state():
+    """Pick up a PDF loaded by another worker process (or before a restart)."""
+    state = shared_state.read_if_changed()
+    if state:
+        pdf_service.restore_state(state["pdf"])
+        chat_service.restore_state(state["chat"])
+        logger.info(f"Loaded shared PDF state for {state['chat'].get('filename')}")
+
+def publish_shared_state():
+    """Make the PDF loaded by this worker visible to the other workers."""
+    shared_state.write({
+        "pdf": pdf_service.export_state(),
+        "chat": chat_service.export_state()
+    })
+
+async def periodic_cleanup():
+    """Remove old uploaded PDFs every CLEANUP_INTERVAL_SECONDS."""
+    while True:
+        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
+        pdf_service.cleanup_old_files()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Application lifespan manager."""
-    global pdf_service, chat_service
+    global pdf_service, chat_service, shared_state
     
     # Startup
     logger.info("Starting PDF Chatbot application with RAG capabilities...")
@@ -41,7 +79,12 @@ async def lifespan(app: FastAPI):
         raise
     
     # Initialize services
-    pdf_service = PDFService(upload_dir=settings.UPLOAD_DIR)
+    # Split CPU cores for PDF parsing and OpenAI rate limits between the worker processes
+    workers = max(1, settings.WORKERS)
+    pdf_service = PDFService(
+        upload_dir=settings.UPLOAD_DIR,
+        max_workers=max(1, (os.cpu_count() or 1) // workers)
+    )
     chat_service = ChatService(
         api_key=settings.OPENAI_API_KEY,
         weaviate_url=settings.WEAVIATE_URL,
@@ -49,8 +92,17 @@ async def lifespan(app: FastAPI):
         weaviate_class_name=settings.WEAVIATE_CLASS_NAME,
         model=settings.DEFAULT_MODEL,
         max_tokens=settings.MAX_TOKENS,
-        temperature=settings.TEMPERATURE
+        temperature=settings.TEMPERATURE,
+        max_history_tokens=settings.MAX_HISTORY_TOKENS,
+        enable_query_cache=settings.RAG_QUERY_CACHE,
+        openai_rpm=max(1, settings.OPENAI_RPM // workers),
+        openai_tpm=max(1, settings.OPENAI_TPM // workers),
+        mmr_lambda=settings.RAG_MMR_LAMBDA
     )
+    shared_state = SharedState(os.path.join(settings.UPLOAD_DIR, "current_pdf.json"))
+    sync_shared_state()
+    
+    cleanup_task = asyncio.create_task(periodic_cleanup())
     
     logger.info("Application started successfully")
     
@@ -58,14 +110,19 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     logger.info("Shutting down PDF Chatbot application...")
+    cleanup_task.cancel()
     if pdf_service:
         pdf_service.cleanup_old_files()
+        pdf_service.shutdown()
+    if chat_service:
+        await chat_service.aclose()
 
 # Create FastAPI app
 app = FastAPI(
     title="PDF Chatbot API with RAG",
     description="A conversational chatbot that can interact with PDF documents using RAG",
-    version="2.0.0",
+    version=API_VERSION,
+    default_response_class=ORJSONResponse,
     lifespan=lifespan
 )
 
@@ -78,21 +135,24 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@lru_cache(maxsize=1)
+def _health_payload(second: int) -> bytes:
+    """Serialized health response; rebuilt at most once per second."""
+    return orjson.dumps({
+        "status": "healthy",
+        "timestamp": datetime.fromtimestamp(second),
+        "version": API_VERSION
+    })
+
 @app.get("/", response_model=HealthResponse)
 async def root():
     """Root endpoint with health information."""
-    return HealthResponse(
-        status="healthy",
-        version="2.0.0"
-    )
+    return Response(content=_health_payload(int(time.time())), media_type="application/json")
 
 @app.get("/health", response_model=HealthResponse)
 async def health_check():
     """Health check endpoint."""
-    return HealthResponse(
-        status="healthy",
-        version="2.0.0"
-    )
+    return Response(content=_health_payload(int(time.time())), media_type="application/json")
 
 @app.post("/upload-pdf", response_model=UploadResponse)
 async def upload_pdf(file: UploadFile = File(...)):
@@ -110,21 +170,53 @@ async def upload_pdf(file: UploadFile = File(...)):
         if not file.filename.lower().endswith('.pdf'):
             raise HTTPException(status_code=400, detail="Only PDF files are allowed")
         
-        # Read file content
-        content = await file.read()
+        # Stream file to disk, enforcing the size limit as chunks arrive
+        pdf_path = pdf_service.get_upload_path(file.filename)
+        tmp_path = f"{pdf_path}.part"
+        total_size = 0
+        digest = hashlib.sha256()
+        try:
+            async with aiofiles.open(tmp_path, 'wb') as out:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    total_size += len(chunk)
+                    digest.update(chunk)
+                    if total_size > settings.MAX_FILE_SIZE:
+                        raise HTTPException(
+                            status_code=413,
+                            detail=f"File size exceeds maximum limit of {settings.MAX_FILE_SIZE // (1024*1024)}MB"
+                        )
+                    await out.write(chunk)
+            os.replace(tmp_path, pdf_path)
+            pdf_service.register_upload(pdf_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        content_hash = digest.hexdigest()
         
-        # Validate file size
-        if len(content) > settings.MAX_FILE_SIZE:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"File size exceeds maximum limit of {settings.MAX_FILE_SIZE // (1024*1024)}MB"
+        # Skip re-processing and re-embedding if this exact file is already loaded (by any worker)
+        sync_shared_state()
+        if (content_hash == pdf_service.get_current_content_hash()
+                and pdf_path == pdf_service.get_current_pdf_path()
+                and file.filename == chat_service.current_filename):
+            logger.info(f"PDF already processed, reusing existing data: {file.filename}")
+            return UploadResponse(
+                filename=file.filename,
+                pages=pdf_service.get_current_num_pages(),
+                text_length=pdf_service.get_current_text_length(),
+                message=f"PDF already processed. Using existing {pdf_service.get_current_chunk_count()} chunks for RAG."
             )
         
         # Process PDF with enhanced chunking
-        extracted_text, num_pages, text_length, chunks = pdf_service.process_pdf(content, file.filename)
+        extracted_text, num_pages, text_length, chunks = await pdf_service.process_pdf(pdf_path, content_hash)
         
         # Set PDF context for chat service (including chunks for RAG)
-        chat_service.set_pdf_context(extracted_text, chunks, file.filename)
+        # (embedding and indexing are blocking network calls, so keep them off the event loop)
+        context_ready = await asyncio.to_thread(chat_service.set_pdf_context, extracted_text, chunks, file.filename)
+        if not context_ready:
+            # Don't let a re-upload of this file skip processing while its embeddings are incomplete
+            pdf_service.clear_content_hash()
+        publish_shared_state()
         
         logger.info(f"PDF uploaded successfully: {file.filename} ({num_pages} pages, {len(chunks)} chunks)")
         
@@ -153,15 +245,17 @@ async def chat(request: ChatRequest):
         Chat response with AI reply and updated conversation history
     """
     try:
+        sync_shared_state()
+        
         # Check if PDF is loaded
-        if not pdf_service.get_current_pdf_text():
+        if not pdf_service.get_current_text_length():
             raise HTTPException(
                 status_code=400, 
                 detail="No PDF loaded. Please upload a PDF first."
             )
         
         # Process chat message with RAG
-        result = chat_service.chat(request.message, request.conversation_history)
+        result = await chat_service.chat(request.message, request.conversation_history)
         
         return ChatResponse(
             response=result["response"],
@@ -179,6 +273,7 @@ async def chat(request: ChatRequest):
 async def get_model_info():
     """Get information about the current model configuration and RAG status."""
     try:
+        sync_shared_state()
         return chat_service.get_model_info()
     except Exception as e:
         logger.error(f"Error getting model info: {str(e)}")
@@ -188,19 +283,20 @@ async def get_model_info():
 async def get_pdf_info():
     """Get information about the currently loaded PDF."""
     try:
-        pdf_text = pdf_service.get_current_pdf_text()
+        sync_shared_state()
+        text_length = pdf_service.get_current_text_length()
         pdf_path = pdf_service.get_current_pdf_path()
-        chunks = pdf_service.get_current_chunks()
+        chunks_count = pdf_service.get_current_chunk_count()
         
-        if not pdf_text:
+        if not text_length:
             return {"message": "No PDF currently loaded"}
         
         return {
             "filename": os.path.basename(pdf_path) if pdf_path else "Unknown",
-            "text_length": len(pdf_text),
-            "has_content": bool(pdf_text.strip()),
-            "chunks_count": len(chunks),
-            "rag_ready": len(chunks) > 5
+            "text_length": text_length,
+            "has_content": pdf_service.current_pdf_has_content(),
+            "chunks_count": chunks_count,
+            "rag_ready": chunks_count > 5
         }
         
     except Exception as e:
@@ -211,12 +307,12 @@ async def get_pdf_info():
 async def global_exception_handler(request, exc):
     """Global exception handler."""
     logger.error(f"Unhandled exception: {str(exc)}")
-    return JSONResponse(
+    return ORJSONResponse(
         status_code=500,
         content=ErrorResponse(
             error="Internal server error",
             detail=str(exc)
-        ).dict()
+        ).model_dump(mode="json")
     )
 
 if __name__ == "__main__":
@@ -225,5 +321,6 @@ if __name__ == "__main__":
         "app.main:app",
         host=settings.HOST,
         port=settings.PORT,
-        reload=settings.DEBUG
+        reload=settings.DEBUG,
+        workers=settings.WORKERS
     ) 
\ No newline at end of file
@@ -2,47 +2,105 @@
 Enhanced chat service for handling AI interactions using OpenAI with RAG capabilities.
 """
 
+import asyncio
 import logging
 from typing import List, Optional, Dict, Any
-from openai import OpenAI
-import tiktoken
+import httpx
+from openai import AsyncOpenAI
 
 from ..models import ChatMessage
+from ..utils.tokenizer import count_tokens, count_tokens_batch, count_tokens_uncached
 from .rag_service import RAGService
 
 logger = logging.getLogger(__name__)
 
+# Characters of raw PDF text kept as context when RAG is not used
+SIMPLE_CONTEXT_CHARS = 5000
+
+# Context window sizes (tokens) by model name prefix; the longest matching prefix wins
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4.1": 1047576,
+}
+DEFAULT_CONTEXT_WINDOW = 8192
+
+# Approximate per-message formatting overhead in the chat format, plus a safety margin
+MESSAGE_OVERHEAD_TOKENS = 4
+CONTEXT_SAFETY_MARGIN = 64
+
 class ChatService:
     """Enhanced service for handling chat interactions with AI using OpenAI and RAG."""
     
     def __init__(self, api_key: str, weaviate_url: str, weaviate_api_key: str = "", 
                  weaviate_class_name: str = "PDFChunks", model: str = "gpt-3.5-turbo", 
-                 max_tokens: int = 1000, temperature: float = 0.7):
+                 max_tokens: int = 1000, temperature: float = 0.7, max_history_tokens: int = 4000,
+                 enable_query_cache: bool = False, openai_rpm: int = 3500, openai_tpm: int = 1_000_000,
+                 mmr_lambda: Optional[float] = None):
         """Initialize chat service with OpenAI and Weaviate configuration."""
         self.api_key = api_key
         self.model = model
         self.max_tokens = max_tokens
         self.temperature = temperature
+        self.max_history_tokens = max_history_tokens
         
-        # Initialize OpenAI client
-        self.client = OpenAI(api_key=api_key)
+        # Initialize async OpenAI client with a pooled HTTP/2 keep-alive connection
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            http_client=httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(
+                    max_keepalive_connections=50,
+                    max_connections=100,
+                    keepalive_expiry=60
+                )
+            )
+        )
+        
+        # Constant part of the system prompt, built and measured once
+        self._base_prompt = """You are a helpful AI assistant that can answer questions about PDF documents. 
+        You should provide accurate, helpful, and concise responses based on the information available in the PDF.
+        
+        Guidelines:
+        - Only answer questions based on the information provided in the PDF
+        - If the information is not available in the PDF, clearly state that
+        - Be helpful and conversational in your responses
+        - Provide specific references when possible (mention page numbers if available)
+        - Keep responses concise but informative
+        - If you're referencing specific content, cite the page number
+        """
+        self._base_prompt_tokens = count_tokens(self._base_prompt)
         
         # Initialize RAG service with Weaviate
         self.rag_service = RAGService(
             api_key=api_key,
             weaviate_url=weaviate_url,
             weaviate_api_key=weaviate_api_key,
-            class_name=weaviate_class_name
+            class_name=weaviate_class_name,
+            enable_query_cache=enable_query_cache,
+            openai_rpm=openai_rpm,
+            openai_tpm=openai_tpm,
+            mmr_lambda=mmr_lambda
         )
         
-        # Store PDF context
+        # Store PDF context (raw text is only kept when RAG is not used)
         self.pdf_context: Optional[str] = None
+        self.pdf_context_len: int = 0
         self.use_rag: bool = False
         self.current_filename: str = None
     
-    def set_pdf_context(self, pdf_text: str, chunks=None, filename: str = "unknown.pdf"):
-        """Set the PDF context for the chat service."""
-        self.pdf_context = pdf_text
+    def set_pdf_context(self, pdf_text: str, chunks=None, filename: str = "unknown.pdf") -> bool:
+        """
+        Set the PDF context for the chat service.
+        
+        Returns:
+            False if RAG was needed but embedding the chunks failed, True otherwise
+        """
+        success = True
+        self.pdf_context = None
+        self.pdf_context_len = len(pdf_text)
         self.current_filename = filename
         
         # If chunks are provided, use RAG
@@ -58,34 +116,88 @@ class ChatService:
         else:
             self.use_rag = False
             logger.info("Using simple context mode")
-    
-    def create_system_prompt(self, relevant_context: str = "") -> str:
-        """Create system prompt for the AI."""
-        base_prompt = """You are a helpful AI assistant that can answer questions about PDF documents. 
-        You should provide accurate, helpful, and concise responses based on the information available in the PDF.
         
-        Guidelines:
-        - Only answer questions based on the information provided in the PDF
-        - If the information is not available in the PDF, clearly state that
-        - Be helpful and conversational in your responses
-        - Provide specific references when possible (mention page numbers if available)
-        - Keep responses concise but informative
-        - If you're referencing specific content, cite the page number
-        """
+        # With RAG active the raw text is never read; otherwise only the prompt preview is needed
+        if not self.use_rag:
+            self.pdf_context = pdf_text[:SIMPLE_CONTEXT_CHARS]
+        
+        return success
+    
+    def export_state(self) -> Dict[str, Any]:
+        """Export the PDF context so other worker processes can restore it."""
+        return {
+            "filename": self.current_filename,
+            "use_rag": self.use_rag,
+            "pdf_context": self.pdf_context,
+            "pdf_context_len": self.pdf_context_len
+        }
+    
+    def restore_state(self, state: Dict[str, Any]):
+        """Restore PDF context exported by another worker process (embeddings already live in Weaviate)."""
+        self.current_filename = state.get("filename")
+        self.use_rag = state.get("use_rag", False)
+        self.pdf_context = state.get("pdf_context")
+        self.pdf_context_len = state.get("pdf_context_len", 0)
         
+        # Another worker re-indexed data, so cached search results may be stale
+        self.rag_service.clear_query_cache()
+    
+    def create_system_prompt(self, relevant_context: str = "") -> str:
+        """Create system prompt for the AI (always starts with the constant base prompt)."""
         if relevant_context:
-            base_prompt += f"\n\nRelevant PDF Content:\n{relevant_context}"
+            return f"{self._base_prompt}\n\nRelevant PDF Content:\n{relevant_context}"
         elif self.pdf_context and not self.use_rag:
             # Fallback to simple context for short PDFs
             context_preview = self.pdf_context[:4000]
-            base_prompt += f"\n\nPDF Content:\n{context_preview}"
+            prompt = f"{self._base_prompt}\n\nPDF Content:\n{context_preview}"
             
-            if len(self.pdf_context) > 4000:
-                base_prompt += "\n\n[Note: This is a preview of the PDF content. The full document contains more information.]"
+            if self.pdf_context_len > 4000:
+                prompt += "\n\n[Note: This is a preview of the PDF content. The full document contains more information.]"
+            return prompt
+        
+        return self._base_prompt
+    
+    def _context_window(self) -> int:
+        """Get the context window size of the configured model."""
+        matches = [prefix for prefix in MODEL_CONTEXT_WINDOWS if self.model.startswith(prefix)]
+        if not matches:
+            return DEFAULT_CONTEXT_WINDOW
+        return MODEL_CONTEXT_WINDOWS[max(matches, key=len)]
+    
+    def _fit_history(self, system_prompt: str, message: str,
+                     conversation_history: List[ChatMessage]) -> List[ChatMessage]:
+        """
+        Select the most recent history messages that fit in the remaining token budget.
         
-        return base_prompt
+        The budget is what is left of the model's context window after the system prompt,
+        the current message and the reserved completion tokens, capped at max_history_tokens.
+        """
+        # Only the variable tail of the system prompt needs encoding; the base is pre-counted.
+        # The retrieved context and new message are one-off strings, so keep them out of the
+        # token cache; history messages recur on every turn and are cached.
+        system_tail_tokens, message_tokens = count_tokens_uncached(
+            [system_prompt[len(self._base_prompt):], message]
+        )
+        system_tokens = self._base_prompt_tokens + system_tail_tokens
+        history_counts = count_tokens_batch([msg.content for msg in conversation_history])
+        
+        budget = (self._context_window() - self.max_tokens - system_tokens - message_tokens
+                  - 2 * MESSAGE_OVERHEAD_TOKENS - CONTEXT_SAFETY_MARGIN)
+        budget = min(budget, self.max_history_tokens)
+        
+        # Walk backwards from the newest message, keeping messages while they fit
+        used = 0
+        start = len(conversation_history)
+        for i in range(len(conversation_history) - 1, -1, -1):
+            msg_tokens = history_counts[i] + MESSAGE_OVERHEAD_TOKENS
+            if used + msg_tokens > budget:
+                break
+            used += msg_tokens
+            start = i
+        
+        return conversation_history[start:]
     
-    def chat(self, message: str, conversation_history: Optional[List[ChatMessage]] = None) -> Dict[str, Any]:
+    async def chat(self, message: str, conversation_history: Optional[List[ChatMessage]] = None) -> Dict[str, Any]:
         """
         Process a chat message and return AI response using RAG when available.
         
@@ -100,7 +212,9 @@ class ChatService:
             # Get relevant context using RAG or fallback
             relevant_context = ""
             if self.use_rag:
-                relevant_context = self.rag_service.get_relevant_context(
+                # Weaviate client is synchronous; keep it off the event loop
+                relevant_context = await asyncio.to_thread(
+                    self.rag_service.get_relevant_context,
                     message, 
                     max_tokens=5000, 
                     filename=self.current_filename
@@ -108,7 +222,7 @@ class ChatService:
                 logger.info(f"RAG retrieved {len(relevant_context)} characters of relevant context")
             elif self.pdf_context:
                 # Simple fallback for short PDFs
-                relevant_context = self.pdf_context[:5000]
+                relevant_context = self.pdf_context
             
             # Create system prompt
             system_prompt = self.create_system_prompt(relevant_context)
@@ -119,9 +233,9 @@ class ChatService:
             # Add system message
             messages.append({"role": "system", "content": system_prompt})
             
-            # Add conversation history (keep last 8 messages to save tokens for context)
+            # Add as much recent conversation history as fits in the token budget
             if conversation_history:
-                for msg in conversation_history[-8:]:
+                for msg in self._fit_history(system_prompt, message, conversation_history):
                     messages.append({
                         "role": msg.role,
                         "content": msg.content
@@ -131,7 +245,7 @@ class ChatService:
             messages.append({"role": "user", "content": message})
             
             # Get AI response from OpenAI
-            response = self.client.chat.completions.create(
+            response = await self.client.chat.completions.create(
                 model=self.model,
                 messages=messages,
                 max_tokens=self.max_tokens,
@@ -169,8 +283,12 @@ class ChatService:
             "model": self.model,
             "max_tokens": self.max_tokens,
             "temperature": self.temperature,
-            "has_pdf_context": bool(self.pdf_context),
+            "has_pdf_context": self.pdf_context_len > 0,
             "rag_enabled": self.use_rag,
             "current_filename": self.current_filename,
             "rag_stats": rag_stats
-        } 
\ No newline at end of file
+        }
+    
+    async def aclose(self):
+        """Close the pooled OpenAI HTTP connections."""
+        await self.client.close()
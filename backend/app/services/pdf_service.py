@@ -2,16 +2,37 @@
 Enhanced PDF processing service for extracting and chunking text from PDF documents.
 """
 
+import asyncio
+import multiprocessing
 import os
-import PyPDF2
-from typing import Tuple, Optional, List, Dict, Any
+import time
+import pypdfium2 as pdfium
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Tuple, Optional, List, Dict, Any, Iterator
 import logging
 from pathlib import Path
 import re
-import tiktoken
+
+from ..utils.tokenizer import count_tokens, count_tokens_batch, set_encode_threads
 
 logger = logging.getLogger(__name__)
 
+# Precompiled patterns for text cleaning
+_PAGE_NUMBER_RE = re.compile(r'^\s*\d+\s*$', re.MULTILINE)  # Standalone page numbers
+_WHITESPACE_RE = re.compile(r'\s+')
+_OCR_FIXES = str.maketrans({'|': 'I'})  # Common OCR mistakes
+
+# Characters replaced in uploaded filenames
+_UNSAFE_FILENAME_CHARS = str.maketrans({c: '_' for c in '<>:"|?*\\/'})
+
+# Sentence boundary: terminator followed by whitespace (fixed-width lookbehind, no backtracking)
+_SENTENCE_BOUNDARY_RE = re.compile(r'(?<=[.!?])\s+')
+
+# Smallest page range handed to one pool worker (smaller ranges cost more in IPC than they save)
+MIN_PAGES_PER_TASK = 8
+
 class PDFChunk:
     """Represents a chunk of text from a PDF with metadata."""
     
@@ -27,31 +48,33 @@ class PDFChunk:
 class PDFService:
     """Enhanced service for processing PDF documents with chunking and metadata."""
     
-    def __init__(self, upload_dir: str = "uploads"):
+    def __init__(self, upload_dir: str = "uploads", max_workers: Optional[int] = None):
         """Initialize PDF service with upload directory."""
         self.upload_dir = Path(upload_dir)
         self.upload_dir.mkdir(exist_ok=True)
-        self._current_pdf_text: Optional[str] = None
+        self.max_workers = max_workers or os.cpu_count()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._current_text_length: int = 0
+        self._current_has_content: bool = False
         self._current_pdf_path: Optional[str] = None
-        self._current_chunks: List[PDFChunk] = []
+        self._current_chunk_count: int = 0
+        self._current_num_pages: int = 0
+        self._current_content_hash: Optional[str] = None
         
-        # Initialize tokenizer for chunking
-        try:
-            self.tokenizer = tiktoken.get_encoding("cl100k_base")  # GPT-4 tokenizer
-        except:
-            self.tokenizer = None
+        # Uploaded files in save-time order (oldest first), built on first use
+        self._file_index: Optional["OrderedDict[str, float]"] = None
     
     def count_tokens(self, text: str) -> int:
         """Count tokens in text using tiktoken."""
-        if self.tokenizer:
-            return len(self.tokenizer.encode(text))
-        else:
-            # Fallback: rough estimate (1 token ≈ 4 characters)
-            return len(text) // 4
+        return count_tokens(text)
+    
+    def count_tokens_batch(self, texts: List[str]) -> List[int]:
+        """Count tokens for many texts with a single batched tiktoken call (cached per text)."""
+        return count_tokens_batch(texts)
     
     def extract_text_from_pdf(self, pdf_path: str) -> Tuple[str, int, List[PDFChunk]]:
         """
-        Extract text from a PDF file with enhanced processing.
+        Extract text from a PDF file with enhanced processing (all pages, in this process).
         
         Args:
             pdf_path: Path to the PDF file
@@ -59,190 +82,276 @@ class PDFService:
         Returns:
             Tuple of (extracted_text, number_of_pages, chunks)
         """
+        page_results = self.extract_pages(pdf_path)
+        extracted_text, chunks = self._combine_pages(page_results)
+        logger.info(f"Successfully extracted text from {pdf_path} ({len(page_results)} pages, {len(chunks)} chunks)")
+        return extracted_text, len(page_results), chunks
+    
+    def count_pages(self, pdf_path: str) -> int:
+        """Get the number of pages in a PDF."""
         try:
-            with open(pdf_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                num_pages = len(pdf_reader.pages)
-                
-                all_text = []
-                all_chunks = []
-                
-                for page_num in range(num_pages):
-                    page = pdf_reader.pages[page_num]
-                    page_text = page.extract_text()
-                    
-                    if page_text.strip():  # Only process non-empty pages
-                        # Clean up the text
-                        cleaned_text = self._clean_text(page_text)
-                        all_text.append(cleaned_text)
-                        
-                        # Create chunks for this page
-                        page_chunks = self._create_chunks(cleaned_text, page_num)
-                        all_chunks.extend(page_chunks)
-                
-                extracted_text = '\n\n'.join(all_text)
-                logger.info(f"Successfully extracted text from {pdf_path} ({num_pages} pages, {len(all_chunks)} chunks)")
-                
-                return extracted_text, num_pages, all_chunks
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                return len(pdf)
+            finally:
+                pdf.close()
+        except Exception as e:
+            logger.error(f"Error opening PDF {pdf_path}: {str(e)}")
+            raise ValueError(f"Failed to extract text from PDF: {str(e)}")
+    
+    def extract_pages(self, pdf_path: str, start: int = 0,
+                      end: Optional[int] = None) -> List[Tuple[Optional[str], List[PDFChunk]]]:
+        """
+        Extract, clean and chunk pages [start, end) of a PDF.
+        
+        Args:
+            pdf_path: Path to the PDF file
+            start: First page to process
+            end: Page after the last one to process (defaults to the end of the document)
+            
+        Returns:
+            One (cleaned_text, chunks) pair per page; cleaned_text is None for empty pages
+        """
+        try:
+            # PDFium is not thread-safe, so pages are read sequentially within a process
+            pdf = pdfium.PdfDocument(pdf_path)
+            try:
+                end = len(pdf) if end is None else end
+                page_texts = []
                 
+                for page_num in range(start, end):
+                    page = pdf[page_num]
+                    textpage = page.get_textpage()
+                    page_texts.append(textpage.get_text_range())
+                    textpage.close()
+                    page.close()
+            finally:
+                pdf.close()
+            
+            return [self._process_page(page_text, start + offset)
+                    for offset, page_text in enumerate(page_texts)]
+            
         except Exception as e:
             logger.error(f"Error extracting text from PDF {pdf_path}: {str(e)}")
             raise ValueError(f"Failed to extract text from PDF: {str(e)}")
     
-    def _clean_text(self, text: str) -> str:
-        """Clean and normalize extracted text."""
-        # Remove excessive whitespace
-        text = re.sub(r'\s+', ' ', text)
+    @staticmethod
+    def _combine_pages(page_results: List[Tuple[Optional[str], List[PDFChunk]]]) -> Tuple[str, List[PDFChunk]]:
+        """Join per-page results (in page order) into the document text and chunk list."""
+        all_text = []
+        all_chunks = []
         
-        # Remove page numbers and headers/footers (common patterns)
-        text = re.sub(r'^\s*\d+\s*$', '', text, flags=re.MULTILINE)  # Standalone page numbers
+        for cleaned_text, page_chunks in page_results:
+            if cleaned_text is not None:
+                all_text.append(cleaned_text)
+                all_chunks.extend(page_chunks)
         
+        return '\n\n'.join(all_text), all_chunks
+    
+    def _page_ranges(self, num_pages: int) -> List[Tuple[int, int]]:
+        """Split a document into contiguous page ranges, one per pool task."""
+        num_tasks = max(1, min(self.max_workers, num_pages // MIN_PAGES_PER_TASK))
+        bounds = [num_pages * i // num_tasks for i in range(num_tasks + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+    
+    def _process_page(self, page_text: str, page_number: int) -> Tuple[Optional[str], List[PDFChunk]]:
+        """Clean a page's text and split it into chunks; returns (None, []) for empty pages."""
+        if not page_text.strip():
+            return None, []
+        
+        cleaned_text = self._clean_text(page_text)
+        return cleaned_text, list(self._iter_chunks(cleaned_text, page_number))
+    
+    def _clean_text(self, text: str) -> str:
+        """Clean and normalize extracted text."""
         # Fix common OCR issues
-        text = text.replace('|', 'I')  # Common OCR mistake
-        text = text.replace('0', 'O')  # In certain contexts
+        text = text.translate(_OCR_FIXES)
+        
+        # Remove page numbers (must run before newlines are collapsed)
+        text = _PAGE_NUMBER_RE.sub('', text)
         
-        # Remove excessive line breaks
-        text = re.sub(r'\n\s*\n\s*\n+', '\n\n', text)
+        # Collapse all whitespace, including line breaks, to single spaces
+        text = _WHITESPACE_RE.sub(' ', text)
         
         return text.strip()
     
-    def _create_chunks(self, text: str, page_number: int, max_tokens: int = 1000) -> List[PDFChunk]:
-        """Create chunks from text with overlap for better context."""
-        if not text.strip():
-            return []
+    def _iter_chunks(self, text: str, page_number: int, max_tokens: int = 1000) -> Iterator[PDFChunk]:
+        """Split cleaned text into sentences and yield chunks with overlap for better context."""
+        # Split on sentence endings, but be careful with abbreviations (strip each sentence once)
+        sentences = [s for s in map(str.strip, _SENTENCE_BOUNDARY_RE.split(text)) if s]
+        if not sentences:
+            return
         
-        chunks = []
-        sentences = self._split_into_sentences(text)
-        current_chunk = []
+        sentence_token_counts = self.count_tokens_batch(sentences)
+        
+        # The current chunk is sentences[start:i]; its token total is kept as a running sum
+        start = 0
         current_tokens = 0
         chunk_index = 0
         
-        for sentence in sentences:
-            sentence_tokens = self.count_tokens(sentence)
-            
+        for i, sentence_tokens in enumerate(sentence_token_counts):
             # If adding this sentence would exceed the limit
-            if current_tokens + sentence_tokens > max_tokens and current_chunk:
-                # Save current chunk
-                chunk_text = ' '.join(current_chunk)
-                chunk = PDFChunk(
-                    content=chunk_text,
+            if current_tokens + sentence_tokens > max_tokens and i > start:
+                # Emit current chunk
+                yield PDFChunk(
+                    content=' '.join(sentences[start:i]),
                     page_number=page_number,
                     chunk_index=chunk_index,
                     metadata={
                         'tokens': current_tokens,
                         'start_sentence': 0,
-                        'end_sentence': len(current_chunk)
+                        'end_sentence': i - start
                     }
                 )
-                chunks.append(chunk)
                 
                 # Start new chunk with overlap (keep last 2 sentences)
-                overlap_sentences = current_chunk[-2:] if len(current_chunk) >= 2 else current_chunk
-                current_chunk = overlap_sentences + [sentence]
-                current_tokens = sum(self.count_tokens(s) for s in current_chunk)
+                start = max(start, i - 2)
+                current_tokens = sum(sentence_token_counts[start:i])
                 chunk_index += 1
-            else:
-                current_chunk.append(sentence)
-                current_tokens += sentence_tokens
-        
-        # Add the last chunk if it has content
-        if current_chunk:
-            chunk_text = ' '.join(current_chunk)
-            chunk = PDFChunk(
-                content=chunk_text,
-                page_number=page_number,
-                chunk_index=chunk_index,
-                metadata={
-                    'tokens': current_tokens,
-                    'start_sentence': 0,
-                    'end_sentence': len(current_chunk)
-                }
-            )
-            chunks.append(chunk)
-        
-        return chunks
-    
-    def _split_into_sentences(self, text: str) -> List[str]:
-        """Split text into sentences while preserving structure."""
-        # Split on sentence endings, but be careful with abbreviations
-        sentences = re.split(r'(?<=[.!?])\s+', text)
-        
-        # Filter out empty sentences and clean up
-        sentences = [s.strip() for s in sentences if s.strip()]
+            
+            current_tokens += sentence_tokens
         
-        return sentences
+        # Emit the last chunk
+        yield PDFChunk(
+            content=' '.join(sentences[start:]),
+            page_number=page_number,
+            chunk_index=chunk_index,
+            metadata={
+                'tokens': current_tokens,
+                'start_sentence': 0,
+                'end_sentence': len(sentences) - start
+            }
+        )
     
-    def save_pdf(self, file_content: bytes, filename: str) -> str:
+    def get_upload_path(self, filename: str) -> str:
         """
-        Save uploaded PDF file to disk.
+        Get the destination path for an uploaded PDF.
         
         Args:
-            file_content: PDF file content as bytes
             filename: Original filename
             
         Returns:
-            Path to saved file
+            Path inside the upload directory where the PDF should be written
         """
-        try:
-            # Ensure filename is safe
-            safe_filename = self._sanitize_filename(filename)
-            file_path = self.upload_dir / safe_filename
-            
-            with open(file_path, 'wb') as f:
-                f.write(file_content)
-            
-            logger.info(f"PDF saved to {file_path}")
-            return str(file_path)
-            
-        except Exception as e:
-            logger.error(f"Error saving PDF {filename}: {str(e)}")
-            raise ValueError(f"Failed to save PDF: {str(e)}")
+        safe_filename = self._sanitize_filename(filename)
+        return str(self.upload_dir / safe_filename)
+    
+    def _get_pool(self) -> ProcessPoolExecutor:
+        """Get the worker pool used for CPU-bound PDF parsing, creating it on first use."""
+        if self._pool is None:
+            # Spawn rather than fork: the parent runs gRPC/HTTP client threads
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._pool
     
-    def process_pdf(self, file_content: bytes, filename: str) -> Tuple[str, int, int, List[PDFChunk]]:
+    async def _run_in_pool(self, fn, *args):
+        """Run fn in the worker pool, respawning the pool and retrying once if a worker died."""
+        loop = asyncio.get_running_loop()
+        for attempt in range(2):
+            pool = self._get_pool()
+            try:
+                return await loop.run_in_executor(pool, fn, *args)
+            except BrokenProcessPool:
+                # A worker was killed (e.g. OOM or a PDFium crash); the executor is unusable now
+                logger.warning(f"PDF worker pool broke, respawning it (attempt {attempt + 1})")
+                if self._pool is pool:
+                    pool.shutdown(wait=False)
+                    self._pool = None
+                if attempt:
+                    raise
+    
+    async def process_pdf(self, pdf_path: str, content_hash: Optional[str] = None) -> Tuple[str, int, int, List[PDFChunk]]:
         """
-        Process uploaded PDF: save, extract text, and create chunks.
+        Process a PDF already saved to disk: extract text and create chunks.
+        
+        Parsing runs in worker processes so the event loop stays responsive; large documents
+        are split into page ranges that are extracted and chunked in parallel.
         
         Args:
-            file_content: PDF file content as bytes
-            filename: Original filename
+            pdf_path: Path to the saved PDF file
+            content_hash: Optional SHA-256 of the file, used to recognize re-uploads
             
         Returns:
             Tuple of (extracted_text, number_of_pages, text_length, chunks)
         """
-        # Save the PDF
-        pdf_path = self.save_pdf(file_content, filename)
-        
         # Extract text and create chunks
-        extracted_text, num_pages, chunks = self.extract_text_from_pdf(pdf_path)
+        num_pages = await self._run_in_pool(_count_pages_worker, pdf_path)
+        range_results = await asyncio.gather(*(
+            self._run_in_pool(_extract_pages_worker, pdf_path, start, end)
+            for start, end in self._page_ranges(num_pages)
+        ))
+        extracted_text, chunks = self._combine_pages(
+            [page for page_results in range_results for page in page_results]
+        )
+        logger.info(f"Successfully extracted text from {pdf_path} ({num_pages} pages, {len(chunks)} chunks)")
         
-        # Store current PDF info
-        self._current_pdf_text = extracted_text
+        # Store current PDF info (sizes only; chunks live in Weaviate once embedded)
+        self._current_text_length = len(extracted_text)
+        self._current_has_content = bool(extracted_text.strip())
         self._current_pdf_path = pdf_path
-        self._current_chunks = chunks
+        self._current_chunk_count = len(chunks)
+        self._current_num_pages = num_pages
+        self._current_content_hash = content_hash
         
         return extracted_text, num_pages, len(extracted_text), chunks
     
-    def get_current_pdf_text(self) -> Optional[str]:
-        """Get text from the currently loaded PDF."""
-        return self._current_pdf_text
+    def get_current_text_length(self) -> int:
+        """Get the extracted text length of the currently loaded PDF (0 if none)."""
+        return self._current_text_length
+    
+    def current_pdf_has_content(self) -> bool:
+        """Check whether the currently loaded PDF has any non-whitespace text."""
+        return self._current_has_content
     
     def get_current_pdf_path(self) -> Optional[str]:
         """Get path of the currently loaded PDF."""
         return self._current_pdf_path
     
-    def get_current_chunks(self) -> List[PDFChunk]:
-        """Get chunks from the currently loaded PDF."""
-        return self._current_chunks
+    def get_current_chunk_count(self) -> int:
+        """Get the number of chunks in the currently loaded PDF."""
+        return self._current_chunk_count
+    
+    def get_current_num_pages(self) -> int:
+        """Get the page count of the currently loaded PDF."""
+        return self._current_num_pages
+    
+    def get_current_content_hash(self) -> Optional[str]:
+        """Get the SHA-256 of the currently loaded PDF, if known."""
+        return self._current_content_hash
+    
+    def clear_content_hash(self):
+        """Forget the current PDF's hash so re-uploading the same file is fully processed again."""
+        self._current_content_hash = None
+    
+    def export_state(self) -> Dict[str, Any]:
+        """Export the current PDF info so other worker processes can restore it."""
+        return {
+            "pdf_path": self._current_pdf_path,
+            "text_length": self._current_text_length,
+            "has_content": self._current_has_content,
+            "chunk_count": self._current_chunk_count,
+            "num_pages": self._current_num_pages,
+            "content_hash": self._current_content_hash
+        }
+    
+    def restore_state(self, state: Dict[str, Any]):
+        """Restore PDF info exported by another worker process."""
+        self._current_pdf_path = state.get("pdf_path")
+        self._current_text_length = state.get("text_length", 0)
+        self._current_has_content = state.get("has_content", False)
+        self._current_chunk_count = state.get("chunk_count", 0)
+        self._current_num_pages = state.get("num_pages", 0)
+        self._current_content_hash = state.get("content_hash")
     
     def _sanitize_filename(self, filename: str) -> str:
         """Sanitize filename to prevent security issues."""
         # Remove path traversal attempts
         filename = os.path.basename(filename)
         
-        # Remove or replace dangerous characters
-        dangerous_chars = ['<', '>', ':', '"', '|', '?', '*', '\\', '/']
-        for char in dangerous_chars:
-            filename = filename.replace(char, '_')
+        # Replace dangerous characters in a single pass
+        filename = filename.translate(_UNSAFE_FILENAME_CHARS)
         
         # Ensure it ends with .pdf
         if not filename.lower().endswith('.pdf'):
@@ -250,17 +359,78 @@ class PDFService:
         
         return filename
     
+    def shutdown(self):
+        """Shut down the PDF parsing worker pool."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+    
+    def _get_file_index(self) -> "OrderedDict[str, float]":
+        """Get the upload index, seeding it from files already on disk (e.g. before a restart)."""
+        if self._file_index is None:
+            existing = sorted(
+                (file_path.stat().st_mtime, str(file_path))
+                for file_path in self.upload_dir.glob("*.pdf")
+            )
+            self._file_index = OrderedDict((path, mtime) for mtime, path in existing)
+        return self._file_index
+    
+    def register_upload(self, pdf_path: str):
+        """Record a newly saved PDF so cleanup can expire it without scanning the directory."""
+        file_index = self._get_file_index()
+        file_index[pdf_path] = time.time()
+        file_index.move_to_end(pdf_path)
+    
     def cleanup_old_files(self, max_age_hours: int = 24):
-        """Clean up old PDF files to save disk space."""
+        """
+        Clean up old PDF files to save disk space.
+        
+        Files are expired from the front of the save-time ordered index, so each call
+        only touches the files that are actually removed.
+        """
         try:
-            import time
-            current_time = time.time()
-            max_age_seconds = max_age_hours * 3600
+            file_index = self._get_file_index()
+            cutoff = time.time() - max_age_hours * 3600
             
-            for file_path in self.upload_dir.glob("*.pdf"):
-                if current_time - file_path.stat().st_mtime > max_age_seconds:
-                    file_path.unlink()
-                    logger.info(f"Cleaned up old file: {file_path}")
+            while file_index:
+                path, saved_at = next(iter(file_index.items()))
+                if saved_at >= cutoff:
+                    break
+                file_index.popitem(last=False)
+                
+                file_path = Path(path)
+                try:
+                    mtime = file_path.stat().st_mtime
+                except FileNotFoundError:
+                    continue
+                
+                # Re-uploaded since it was indexed (e.g. by another worker process)
+                if mtime >= cutoff:
+                    file_index[path] = mtime
+                    continue
+                
+                file_path.unlink()
+                logger.info(f"Cleaned up old file: {file_path}")
                     
         except Exception as e:
-            logger.warning(f"Error during cleanup: {str(e)}") 
\ No newline at end of file
+            logger.warning(f"Error during cleanup: {str(e)}")
+
+# Per-process service used by pool workers (created lazily in each worker)
+_worker_service: Optional[PDFService] = None
+
+def _get_worker_service(pdf_path: str) -> PDFService:
+    """Get this worker process's PDF service, creating it on first use."""
+    global _worker_service
+    if _worker_service is None:
+        # Worker processes already use every core between them; don't nest thread pools
+        set_encode_threads(1)
+        _worker_service = PDFService(upload_dir=os.path.dirname(pdf_path))
+    return _worker_service
+
+def _count_pages_worker(pdf_path: str) -> int:
+    """Count a PDF's pages inside a worker process (keeps PDFium out of the server process)."""
+    return _get_worker_service(pdf_path).count_pages(pdf_path)
+
+def _extract_pages_worker(pdf_path: str, start: int, end: int) -> List[Tuple[Optional[str], List[PDFChunk]]]:
+    """Extract text and chunks for pages [start, end) of a PDF inside a worker process."""
+    return _get_worker_service(pdf_path).extract_pages(pdf_path, start, end)
@@ -2,39 +2,213 @@
 RAG (Retrieval-Augmented Generation) service for handling embeddings and vector search using Weaviate.
 """
 
+import atexit
+import hashlib
 import logging
-from typing import List, Dict, Any, Optional
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, Tuple
+import numpy as np
+from openai import APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from weaviate import WeaviateClient
-from weaviate.classes.config import Property, DataType, Configure
+from weaviate.classes.config import Property, DataType, Configure, Tokenization, VectorDistances, Vectorizers
 from weaviate.classes.query import Filter, MetadataQuery
+from weaviate.util import generate_uuid5
 import weaviate
-from urllib.parse import urlparse
 import uuid
-from datetime import datetime
+from datetime import datetime, timezone
 
 from .pdf_service import PDFChunk
+from ..utils.rate_limiter import TokenBucketLimiter
+from ..utils.tokenizer import count_tokens, count_tokens_uncached
 
 logger = logging.getLogger(__name__)
 
+# OpenAI embedding request limits: inputs per call and total tokens per call (API max is 300k)
+EMBED_BATCH = 512
+EMBED_BATCH_MAX_TOKENS = 250_000
+
+# Concurrent OpenAI embedding requests per upload
+EMBED_CONCURRENCY = 5
+
+# Objects fetched per page when listing what is already stored for a file
+FETCH_PAGE_SIZE = 1000
+
+# Candidates fetched per returned result when MMR re-ranking is enabled
+MMR_OVERSAMPLE = 3
+
+# Polling interval and default timeout when waiting for async HNSW indexing to catch up
+INDEXING_POLL_SECONDS = 1.0
+INDEXING_TIMEOUT_SECONDS = 300.0
+
+# Weaviate client shared by every RAGService in this process
+_weaviate_client: Optional[WeaviateClient] = None
+_weaviate_lock = threading.Lock()
+
+def _get_weaviate_client() -> WeaviateClient:
+    """Get the process-wide Weaviate client, connecting on first use."""
+    global _weaviate_client
+    if _weaviate_client is None:
+        with _weaviate_lock:
+            if _weaviate_client is None:
+                # Local instance without auth
+                _weaviate_client = weaviate.connect_to_local(
+                    skip_init_checks=True
+                )
+                atexit.register(_close_weaviate_client)
+    return _weaviate_client
+
+def _retry_after_seconds(exc: BaseException) -> Optional[float]:
+    """Get the server-requested delay from a rate-limit error's Retry-After headers, if any."""
+    response = getattr(exc, "response", None)
+    if not isinstance(exc, RateLimitError) or response is None:
+        return None
+    
+    try:
+        retry_after_ms = response.headers.get("retry-after-ms")
+        if retry_after_ms is not None:
+            return float(retry_after_ms) / 1000
+        retry_after = response.headers.get("retry-after")
+        if retry_after is not None:
+            return float(retry_after)
+    except ValueError:
+        pass
+    return None
+
+_exponential_backoff = wait_exponential_jitter()
+
+def _embedding_retry_wait(retry_state) -> float:
+    """Wait exactly as long as a 429 response asks, otherwise back off exponentially."""
+    retry_after = _retry_after_seconds(retry_state.outcome.exception())
+    if retry_after is not None:
+        return retry_after
+    return _exponential_backoff(retry_state)
+
+def _mmr_select(vectors: np.ndarray, scores: np.ndarray, k: int, mmr_lambda: float) -> np.ndarray:
+    """
+    Pick k candidates by maximal marginal relevance.
+    
+    Args:
+        vectors: Candidate embeddings, one per row
+        scores: Cosine similarity of each candidate to the query
+        k: Number of candidates to select
+        mmr_lambda: Weight of query relevance versus diversity (1.0 = relevance only)
+        
+    Returns:
+        Indices of the selected candidates in selection order
+    """
+    unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    similarity = unit @ unit.T
+    
+    selected = [int(np.argmax(scores))]
+    max_similarity = similarity[selected[0]].copy()
+    for _ in range(k - 1):
+        mmr = mmr_lambda * scores - (1 - mmr_lambda) * max_similarity
+        mmr[selected] = -np.inf
+        best = int(np.argmax(mmr))
+        selected.append(best)
+        max_similarity = np.maximum(max_similarity, similarity[best])
+    return np.asarray(selected, dtype=np.intp)
+
+def _close_weaviate_client():
+    """Close the shared Weaviate client at interpreter exit."""
+    if _weaviate_client is not None:
+        _weaviate_client.close()
+
+class SemanticQueryCache:
+    """LRU + TTL cache of search results, matched by cosine similarity of query embeddings."""
+    
+    def __init__(self, max_size: int = 512, ttl_seconds: float = 600, threshold: float = 0.95):
+        """Initialize the cache with its size limit, entry lifetime and similarity threshold."""
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.threshold = threshold
+        # (filename, top_k, rounded vector bytes) -> (stored_at, unit vector, results)
+        self._entries: "OrderedDict[Tuple[Optional[str], int, bytes], Tuple[float, np.ndarray, List[Dict[str, Any]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+    
+    def _evict_expired(self, now: float):
+        """Drop entries older than the TTL (hits reorder entries, so every entry is checked)."""
+        expired = [key for key, (stored_at, _, _) in self._entries.items()
+                   if now - stored_at > self.ttl_seconds]
+        for key in expired:
+            del self._entries[key]
+    
+    def get(self, vector: np.ndarray, filename: Optional[str], top_k: int) -> Optional[List[Dict[str, Any]]]:
+        """Return cached results for a sufficiently similar, unexpired query, or None."""
+        with self._lock:
+            now = time.monotonic()
+            self._evict_expired(now)
+            keys = [key for key, (stored_at, _, _) in self._entries.items()
+                    if key[0] == filename and key[1] == top_k and now - stored_at <= self.ttl_seconds]
+            if not keys:
+                return None
+            
+            # One matrix-vector product scores every candidate
+            matrix = np.stack([self._entries[key][1] for key in keys])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.threshold:
+                return None
+            
+            self._entries.move_to_end(keys[best])
+            return list(self._entries[keys[best]][2])
+    
+    def put(self, vector: np.ndarray, filename: Optional[str], top_k: int, results: List[Dict[str, Any]]):
+        """Store results for a query embedding, evicting the least recently used entry on overflow."""
+        key = (filename, top_k, np.round(vector, 3).tobytes())
+        with self._lock:
+            self._entries[key] = (time.monotonic(), vector, list(results))
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+    
+    def clear(self):
+        """Drop all cached results (e.g. after the indexed data changes)."""
+        with self._lock:
+            self._entries.clear()
+
 class RAGService:
     """Service for handling embeddings, vector storage, and semantic search using Weaviate."""
     
     def __init__(self, api_key: str, weaviate_url: str, weaviate_api_key: str = "", 
-                 class_name: str = "PDFChunks", embedding_model: str = "text-embedding-3-large"):
-        """Initialize RAG service with OpenAI and Weaviate configuration."""
+                 class_name: str = "PDFChunks", embedding_model: str = "text-embedding-3-large",
+                 enable_query_cache: bool = False, openai_rpm: int = 3500, openai_tpm: int = 1_000_000,
+                 oversample: int = 1, mmr_lambda: Optional[float] = None):
+        """
+        Initialize RAG service with OpenAI and Weaviate configuration.
+        
+        Searches fetch top_k * oversample candidates from Weaviate. Oversampling only pays off
+        with a client-side re-ranker: a larger limit makes HNSW explore more of the graph and
+        transfer more objects, so it stays at 1 unless MMR (mmr_lambda) is enabled, which raises
+        it to at least MMR_OVERSAMPLE to give the re-ranker diverse candidates to choose from.
+        """
         from openai import OpenAI
         self.client = OpenAI(api_key=api_key)
         self.embedding_model = embedding_model
         self.class_name = class_name
         
-        # Initialize Weaviate client v4 for local instance without auth
-        parsed = urlparse(weaviate_url)
-        self.weaviate_client = weaviate.connect_to_local(
-            skip_init_checks=True
-        )
+        # Optional MMR re-ranking of oversampled candidates for more diverse context
+        self.mmr_lambda = mmr_lambda
+        self.oversample = max(oversample, MMR_OVERSAMPLE) if mmr_lambda is not None else oversample
+        
+        # Pace embedding requests to the account limits instead of running into 429s
+        self.rate_limiter = TokenBucketLimiter(rpm=openai_rpm, tpm=openai_tpm)
+        
+        # Optional semantic cache so near-duplicate queries skip the Weaviate round-trip
+        self.query_cache: Optional[SemanticQueryCache] = SemanticQueryCache() if enable_query_cache else None
+        
+        # Reuse the process-wide Weaviate client v4 (one gRPC/HTTP connection per process)
+        self.weaviate_client = _get_weaviate_client()
         
         # Ensure the class exists
         self._ensure_class_exists()
+        
+        # Collection handle reused by every operation
+        self.collection = self.weaviate_client.collections.get(self.class_name)
     
     def _ensure_class_exists(self):
         """Ensure the Weaviate class exists with proper schema."""
@@ -47,8 +221,14 @@ class RAGService:
                 self.weaviate_client.collections.create(
                     name=self.class_name,
                     description="PDF document chunks with embeddings for semantic search",
-                    vectorizer_config=Configure.Vectorizer.text2vec_openai(
-                        model=self.embedding_model
+                    # Vectors are computed client-side and sent with each object at ingest,
+                    # so no Weaviate vectorizer module is involved
+                    vectorizer_config=Configure.Vectorizer.none(),
+                    # Explicit HNSW parameters (fixed once the class is created)
+                    vector_index_config=Configure.VectorIndex.hnsw(
+                        ef_construction=256,
+                        max_connections=32,
+                        distance_metric=VectorDistances.COSINE
                     ),
                     properties=[
                         Property(
@@ -69,7 +249,9 @@ class RAGService:
                         Property(
                             name="filename",
                             data_type=DataType.TEXT,
-                            description="The source PDF filename"
+                            description="The source PDF filename",
+                            # Match whole filenames; word tokenization makes report.pdf match report_v2.pdf
+                            tokenization=Tokenization.FIELD
                         ),
                         Property(
                             name="uploaded_at",
@@ -87,17 +269,141 @@ class RAGService:
             else:
                 logger.info(f"Weaviate class {self.class_name} already exists")
                 
+                config = self.weaviate_client.collections.get(self.class_name).config.get()
+                
+                # Classes from before client-side embedding use text2vec-openai, which is no longer loaded
+                if config.vectorizer not in (None, Vectorizers.NONE):
+                    raise RuntimeError(
+                        f"Weaviate class {self.class_name} uses the '{config.vectorizer}' vectorizer, but vectors "
+                        f"are now computed by the backend and Weaviate runs without vectorizer modules. "
+                        f"Delete the class (e.g. DELETE /v1/schema/{self.class_name}) and re-upload your PDFs."
+                    )
+                
+                filename_property = next((prop for prop in config.properties if prop.name == "filename"), None)
+                if filename_property is not None and filename_property.tokenization != Tokenization.FIELD:
+                    logger.warning(
+                        f"Weaviate class {self.class_name} tokenizes 'filename' by word; results are "
+                        f"post-filtered by exact filename, but delete the class and re-upload to use "
+                        f"exact server-side filtering"
+                    )
+                
         except Exception as e:
             logger.error(f"Error ensuring Weaviate class exists: {str(e)}")
             raise
     
-    def create_embeddings(self, chunks: List[PDFChunk], filename: str = "unknown.pdf") -> bool:
+    def _embedding_batches(self, chunks: List[PDFChunk]) -> List[List[PDFChunk]]:
+        """Group chunks into embedding requests bounded by input count and total tokens."""
+        batches = []
+        current = []
+        current_tokens = 0
+        
+        for chunk in chunks:
+            chunk_tokens = chunk.metadata.get('tokens', 0)
+            if current and (len(current) >= EMBED_BATCH
+                            or current_tokens + chunk_tokens > EMBED_BATCH_MAX_TOKENS):
+                batches.append(current)
+                current = []
+                current_tokens = 0
+            current.append(chunk)
+            current_tokens += chunk_tokens
+        
+        if current:
+            batches.append(current)
+        return batches
+    
+    @retry(
+        retry=retry_if_exception_type((RateLimitError, APIConnectionError, APITimeoutError, InternalServerError)),
+        stop=stop_after_attempt(6),
+        wait=_embedding_retry_wait,
+        reraise=True
+    )
+    def _embed_texts(self, texts: List[str], tokens: int) -> List[List[float]]:
+        """Embed a batch of texts with a single OpenAI call, preserving input order."""
+        self.rate_limiter.acquire(tokens)
+        
+        # Retries are handled by tenacity above, so disable the client's own
+        response = self.client.with_options(max_retries=0).embeddings.create(
+            model=self.embedding_model,
+            input=texts
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+    
+    @staticmethod
+    def _chunk_uuid(chunk: PDFChunk, filename: str) -> str:
+        """Deterministic object UUID derived from the chunk's position and content."""
+        content_hash = hashlib.sha256(chunk.content.encode('utf-8')).hexdigest()
+        return generate_uuid5(f"{filename}:{chunk.page_number}:{chunk.chunk_index}:{content_hash}")
+    
+    def _existing_uuids(self, filename: str) -> set:
+        """Get the UUIDs of all objects already stored for exactly this filename."""
+        existing = set()
+        offset = 0
+        while True:
+            response = self.collection.query.fetch_objects(
+                filters=Filter.by_property("filename").equal(filename),
+                limit=FETCH_PAGE_SIZE,
+                offset=offset,
+                return_properties=["filename"]
+            )
+            # Classes created before field tokenization match filenames by word, so re-check exactly
+            existing.update(str(obj.uuid) for obj in response.objects
+                            if obj.properties.get("filename") == filename)
+            if len(response.objects) < FETCH_PAGE_SIZE:
+                return existing
+            offset += FETCH_PAGE_SIZE
+    
+    def _vector_queue_length(self) -> int:
+        """Get the number of vectors still waiting to be added to this collection's HNSW index."""
+        nodes = self.weaviate_client.cluster.nodes(collection=self.class_name, output="verbose")
+        return sum(
+            shard.vector_queue_length or 0
+            for node in nodes
+            for shard in (node.shards or [])
+            if shard.collection == self.class_name
+        )
+    
+    def wait_for_indexing(self, timeout: float = INDEXING_TIMEOUT_SECONDS) -> bool:
+        """
+        Wait until Weaviate's async indexing queue for this collection is drained.
+        
+        With ASYNC_INDEXING enabled, inserts return before the HNSW index is updated, so freshly
+        inserted chunks may briefly be missing from search results.
+        
+        Args:
+            timeout: Maximum seconds to wait
+            
+        Returns:
+            True if the queue drained, False on timeout or error
+        """
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                queued = self._vector_queue_length()
+                if not queued:
+                    return True
+                if time.monotonic() >= deadline:
+                    logger.warning(f"Timed out waiting for indexing, {queued} vectors still queued")
+                    return False
+                logger.info(f"Waiting for Weaviate to index {queued} queued vectors...")
+                time.sleep(INDEXING_POLL_SECONDS)
+        
+        except Exception as e:
+            logger.warning(f"Error checking Weaviate indexing status: {str(e)}")
+            return False
+    
+    def create_embeddings(self, chunks: List[PDFChunk], filename: str = "unknown.pdf",
+                          overwrite: bool = False, wait_for_indexing: bool = False) -> bool:
         """
         Create embeddings for PDF chunks and store them in Weaviate.
         
+        Objects are keyed by a hash of their content, so re-uploading a file only embeds and
+        inserts chunks that changed and deletes the ones that are gone.
+        
         Args:
             chunks: List of PDF chunks to embed
             filename: Source PDF filename
+            overwrite: Delete and re-insert every chunk stored for this filename
+            wait_for_indexing: Block until async HNSW indexing has caught up with the inserts
             
         Returns:
             True if successful, False otherwise
@@ -109,36 +415,86 @@ class RAGService:
             
             logger.info(f"Creating embeddings for {len(chunks)} chunks in Weaviate...")
             
-            # Clear existing data for this filename (optional - for updates)
-            self._clear_existing_data(filename)
+            if overwrite:
+                self._clear_existing_data(filename)
             
-            # Get the collection
-            collection = self.weaviate_client.collections.get(self.class_name)
+            collection = self.collection
             
-            # Process chunks in batches
-            batch_size = 100
-            for i in range(0, len(chunks), batch_size):
-                batch_chunks = chunks[i:i + batch_size]
-                
-                # Prepare batch data
-                batch_data = []
-                for chunk in batch_chunks:
-                    data_object = {
+            # Only chunks whose content-derived UUID is not stored yet need embedding
+            chunk_uuids = [self._chunk_uuid(chunk, filename) for chunk in chunks]
+            existing_uuids = set() if overwrite else self._existing_uuids(filename)
+            new_items = [(chunk, chunk_uuid) for chunk, chunk_uuid in zip(chunks, chunk_uuids)
+                         if chunk_uuid not in existing_uuids]
+            
+            # Remove chunks left over from a previous version of this file
+            stale_uuids = list(existing_uuids.difference(chunk_uuids))
+            if stale_uuids:
+                collection.data.delete_many(where=Filter.by_id().contains_any(stale_uuids))
+                logger.info(f"Removed {len(stale_uuids)} stale chunks for filename: {filename}")
+            
+            self.clear_query_cache()
+            
+            if not new_items:
+                logger.info(f"All {len(chunks)} chunks already stored in Weaviate, nothing to embed")
+                return True
+            new_chunks = [chunk for chunk, _ in new_items]
+            
+            # Embed chunks client-side: one OpenAI call per batch instead of one per object,
+            # with a few batches in flight at once (results come back in batch order)
+            batches = self._embedding_batches(new_chunks)
+            total_batches = len(batches)
+            logger.info(f"Embedding {len(new_chunks)} new chunks in {total_batches} OpenAI requests")
+            with ThreadPoolExecutor(max_workers=min(EMBED_CONCURRENCY, len(batches))) as executor:
+                batch_vectors = list(executor.map(
+                    self._embed_texts,
+                    [[chunk.content for chunk in batch_chunks] for batch_chunks in batches],
+                    [sum(chunk.metadata.get('tokens', 0) for chunk in batch_chunks) for batch_chunks in batches]
+                ))
+            vectors = [vector for batch in batch_vectors for vector in batch]
+            
+            # All chunks from one upload share the same timestamp
+            uploaded_at = datetime.now(timezone.utc).isoformat()
+            
+            # Let the v4 batcher pipeline concurrent insert requests
+            with collection.batch.fixed_size(batch_size=200, concurrent_requests=4) as batch:
+                for (chunk, chunk_uuid), vector in zip(new_items, vectors):
+                    batch.add_object(uuid=chunk_uuid, vector=vector, properties={
                         "content": chunk.content,
                         "page_number": chunk.page_number,
                         "chunk_index": chunk.chunk_index,
                         "filename": filename,
-                        "uploaded_at": datetime.now().isoformat(),
+                        "uploaded_at": uploaded_at,
                         "tokens": chunk.metadata.get('tokens', 0)
-                    }
-                    batch_data.append(data_object)
-                
-                # Add batch to Weaviate using v4 API
-                collection.data.insert_many(batch_data)
+                    })
+            
+            # Retry failed objects once
+            failed_objects = collection.batch.failed_objects
+            if failed_objects:
+                logger.warning(f"Retrying {len(failed_objects)} chunks that failed to insert: {failed_objects[0].message}")
+                with collection.batch.fixed_size(batch_size=200, concurrent_requests=4) as batch:
+                    for failed in failed_objects:
+                        batch.add_object(
+                            properties=failed.object_.properties,
+                            uuid=failed.object_.uuid,
+                            vector=failed.object_.vector
+                        )
                 
-                logger.info(f"Processed batch {i//batch_size + 1}/{(len(chunks) + batch_size - 1)//batch_size}")
+                failed_objects = collection.batch.failed_objects
+                if failed_objects:
+                    # A partial index is not a finished upload; report failure so it gets retried
+                    logger.error(f"Failed to insert {len(failed_objects)} of {len(new_chunks)} chunks: {failed_objects[0].message}")
+                    self.clear_query_cache()
+                    return False
             
-            logger.info(f"Successfully created embeddings for {len(chunks)} chunks in Weaviate")
+            self.clear_query_cache()
+            
+            # One summary for the whole upload instead of per-batch progress lines
+            logger.info(f"Successfully created embeddings in Weaviate: {len(new_chunks) - len(failed_objects)} "
+                        f"inserted from {total_batches} embedding batches, {len(chunks) - len(new_chunks)} unchanged, "
+                        f"{len(failed_objects)} failed")
+            
+            if wait_for_indexing:
+                self.wait_for_indexing()
             return True
             
         except Exception as e:
@@ -148,20 +504,37 @@ class RAGService:
     def _clear_existing_data(self, filename: str):
         """Clear existing data for a specific filename."""
         try:
-            # Get the collection
-            collection = self.weaviate_client.collections.get(self.class_name)
+            collection = self.collection
             
-            # Delete objects with matching filename using v4 API
-            result = collection.data.delete_many(
-                where=Filter.by_property("filename").equal(filename)
-            )
+            # Delete by UUID so only objects with exactly this filename are removed
+            existing_uuids = list(self._existing_uuids(filename))
+            if existing_uuids:
+                collection.data.delete_many(where=Filter.by_id().contains_any(existing_uuids))
             
-            if result:
-                logger.info(f"Cleared {result} existing objects for filename: {filename}")
+            self.clear_query_cache()
+            
+            if existing_uuids:
+                logger.info(f"Cleared {len(existing_uuids)} existing objects for filename: {filename}")
                 
         except Exception as e:
             logger.warning(f"Error clearing existing data: {str(e)}")
     
+    def clear_query_cache(self):
+        """Invalidate cached search results."""
+        if self.query_cache is not None:
+            self.query_cache.clear()
+    
+    def _embed_query(self, query: str) -> np.ndarray:
+        """Embed a query with OpenAI and return it as a unit vector."""
+        # Queries are one-off strings; keep them out of the shared token cache
+        self.rate_limiter.acquire(count_tokens_uncached([query])[0])
+        embedding = self.client.embeddings.create(
+            model=self.embedding_model,
+            input=query
+        ).data[0].embedding
+        vector = np.asarray(embedding, dtype=np.float32)
+        return vector / np.linalg.norm(vector)
+    
     def search(self, query: str, top_k: int = 5, filename: str = None) -> List[Dict[str, Any]]:
         """
         Search for relevant chunks using semantic similarity in Weaviate.
@@ -175,44 +548,78 @@ class RAGService:
             List of relevant chunks with scores
         """
         try:
-            # Get the collection
-            collection = self.weaviate_client.collections.get(self.class_name)
+            # Embed the query client-side (no extra Weaviate -> OpenAI hop per search)
+            query_vector = self._embed_query(query)
             
-            # Always use semantic search for better matching
-            response = collection.query.near_text(
-                query=query,
-                limit=top_k * 3,  # Get more results to filter from
+            # Serve near-duplicate queries from the semantic cache
+            if self.query_cache is not None:
+                cached_results = self.query_cache.get(query_vector, filename, top_k)
+                if cached_results is not None:
+                    logger.info(f"Semantic cache hit: {len(cached_results)} chunks for query: {query[:50]}...")
+                    return cached_results
+            
+            collection = self.collection
+            
+            use_mmr = self.mmr_lambda is not None
+            
+            # Always use semantic search for better matching; the filename filter is applied
+            # server-side during HNSW traversal, so only matching chunks come back
+            response = collection.query.near_vector(
+                near_vector=query_vector.tolist(),
+                limit=top_k * self.oversample,
+                filters=Filter.by_property("filename").equal(filename) if filename else None,
+                include_vector=use_mmr,
                 return_properties=["content", "page_number", "chunk_index", "filename", "tokens"],
                 return_metadata=MetadataQuery(distance=True)
             )
             
+            # Keep exact filename matches only (classes created before field tokenization
+            # match filenames by word, e.g. report.pdf would also match report_v2.pdf)
+            objects = response.objects
+            if filename:
+                objects = [obj for obj in objects if obj.properties['filename'] == filename]
+            
+            # Convert distances to similarities in one vector op and keep the top_k, best first
+            distances = np.fromiter((obj.metadata.distance for obj in objects), dtype=np.float32, count=len(objects))
+            scores = 1.0 - distances
+            k = min(top_k, len(scores))
+            if use_mmr and k:
+                vectors = np.asarray([
+                    obj.vector["default"] if isinstance(obj.vector, dict) else obj.vector
+                    for obj in objects
+                ], dtype=np.float32)
+                top = _mmr_select(vectors, scores, k, self.mmr_lambda)
+            else:
+                top = np.argpartition(-scores, k - 1)[:k] if k else np.empty(0, dtype=np.intp)
+                top = top[np.argsort(-scores[top], kind='stable')]
+            
             # Process results
-            all_results = []
-            for result in response.objects:
-                all_results.append({
-                    'content': result.properties['content'],
-                    'page_number': result.properties['page_number'],
-                    'chunk_index': result.properties['chunk_index'],
-                    'filename': result.properties['filename'],
-                    'score': 1 - result.metadata.distance,  # Convert distance to similarity
-                    'tokens': result.properties['tokens']
+            results = []
+            for i in top:
+                properties = objects[i].properties
+                results.append({
+                    'content': properties['content'],
+                    'page_number': properties['page_number'],
+                    'chunk_index': properties['chunk_index'],
+                    'filename': properties['filename'],
+                    'score': float(scores[i]),
+                    'tokens': properties['tokens']
                 })
             
-            # Filter by filename if specified
-            if filename:
-                filtered_results = [r for r in all_results if r['filename'] == filename]
-                # Return top_k results from filtered results
-                results = filtered_results[:top_k]
-            else:
-                # Return top_k results from all results
-                results = all_results[:top_k]
+            if self.query_cache is not None:
+                self.query_cache.put(query_vector, filename, top_k, results)
             
-            logger.info(f"Found {len(results)} relevant chunks for query: {query[:50]}...")
+            if results:
+                logger.info(f"{len(results)} hits, best={results[0]['score']:.3f}")
+            else:
+                logger.info("0 hits")
             
             # Log the retrieved chunks for debugging
-            for i, result in enumerate(results):
-                logger.info(f"Chunk {i+1}: Page {result['page_number']}, Score: {result['score']:.3f}")
-                logger.info(f"Content: {result['content'][:200]}...")
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f"Query: {query[:50]}...")
+                for i, result in enumerate(results):
+                    logger.debug(f"Chunk {i+1}: Page {result['page_number']}, Score: {result['score']:.3f}")
+                    logger.debug(f"Content: {result['content'][:200]}...")
             
             return results
             
@@ -239,27 +646,30 @@ class RAGService:
             if not results:
                 return ""
             
-            # Build context from top results
-            context_parts = []
-            current_tokens = 0
+            # Use the token count stored at ingest; count (cached) with tiktoken if missing
+            token_counts = np.fromiter(
+                (result.get('tokens') or count_tokens(result['content']) for result in results),
+                dtype=np.int32,
+                count=len(results)
+            )
             
-            for result in results:
-                # Use actual token count if available, otherwise estimate
-                chunk_tokens = result.get('tokens', len(result['content'].split()) * 1.3)
-                
-                if current_tokens + chunk_tokens > max_tokens:
-                    break
-                
-                context_parts.append(
-                    f"[Page {result['page_number']}] {result['content']}"
-                )
-                current_tokens += chunk_tokens
+            # Keep the longest prefix of results whose running token total fits the budget
+            cumulative_tokens = np.cumsum(token_counts)
+            cutoff = int(np.searchsorted(cumulative_tokens, max_tokens, side='right'))
+            current_tokens = int(cumulative_tokens[cutoff - 1]) if cutoff else 0
+            
+            # Build context from top results
+            context_parts = [
+                f"[Page {result['page_number']}] {result['content']}"
+                for result in results[:cutoff]
+            ]
             
             context = "\n\n".join(context_parts)
             
             if context:
-                logger.info(f"Retrieved {len(context_parts)} chunks ({current_tokens:.0f} estimated tokens) for query")
-                logger.info(f"Context preview: {context[:500]}...")
+                logger.info(f"Retrieved {len(context_parts)} chunks ({current_tokens} tokens) for query")
+                if logger.isEnabledFor(logging.DEBUG):
+                    logger.debug(f"Context preview: {context[:500]}...")
             
             return context
             
@@ -270,8 +680,7 @@ class RAGService:
     def get_stats(self) -> Dict[str, Any]:
         """Get statistics about the vector store."""
         try:
-            # Get the collection
-            collection = self.weaviate_client.collections.get(self.class_name)
+            collection = self.collection
             
             # Get total count using v4 API
             response = collection.aggregate.over_all(total_count=True)
@@ -292,11 +701,11 @@ class RAGService:
     def delete_all_data(self) -> bool:
         """Delete all data from the vector store."""
         try:
-            # Get the collection
-            collection = self.weaviate_client.collections.get(self.class_name)
+            collection = self.collection
             
             # Delete all objects using v4 API
             result = collection.data.delete_many()
+            self.clear_query_cache()
             logger.info(f"Deleted {result} objects from Weaviate")
             return True
         except Exception as e:
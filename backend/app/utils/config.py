@@ -2,11 +2,15 @@
 Configuration settings for the PDF Chatbot application.
 """
 
+import logging
 import os
-from typing import List
+from functools import cached_property, lru_cache
+from typing import List, Optional
 from pydantic_settings import BaseSettings, SettingsConfigDict
 from pydantic import field_validator
 
+logger = logging.getLogger(__name__)
+
 class Settings(BaseSettings):
     """Application settings loaded from environment variables."""
     
@@ -18,11 +22,14 @@ class Settings(BaseSettings):
     
     # OpenAI Configuration
     OPENAI_API_KEY: str = "your_openai_api_key_here"
+    OPENAI_RPM: int = 3500  # Requests per minute allowed for the account
+    OPENAI_TPM: int = 1_000_000  # Tokens per minute allowed for the account
     
     # Application Configuration
     DEBUG: bool = True
     HOST: str = "0.0.0.0"
     PORT: int = 8000
+    WORKERS: int = 1  # Uvicorn worker processes; state is shared through UPLOAD_DIR
     UPLOAD_DIR: str = "uploads"
     MAX_FILE_SIZE: int = 50 * 1024 * 1024  # 50MB
     
@@ -33,13 +40,18 @@ class Settings(BaseSettings):
     DEFAULT_MODEL: str = "gpt-3.5-turbo"
     MAX_TOKENS: int = 1000
     TEMPERATURE: float = 0.7
+    MAX_HISTORY_TOKENS: int = 4000  # Upper bound on conversation history sent per request
     
     # Weaviate Configuration
     WEAVIATE_URL: str = "http://localhost:8080"
     WEAVIATE_API_KEY: str = ""
     WEAVIATE_CLASS_NAME: str = "PDFChunks"
     
-    @property
+    # RAG Configuration
+    RAG_QUERY_CACHE: bool = False  # Reuse results for near-duplicate queries
+    RAG_MMR_LAMBDA: Optional[float] = None  # Enable MMR re-ranking (1.0 = relevance only, lower = more diverse)
+    
+    @cached_property
     def allowed_origins_list(self) -> List[str]:
         """Get ALLOWED_ORIGINS as a list."""
         if isinstance(self.ALLOWED_ORIGINS, str):
@@ -51,10 +63,12 @@ class Settings(BaseSettings):
         # Remove quotes if present
         api_key = self.OPENAI_API_KEY.strip('"\'')
         
-        print(f"DEBUG: API key length: {len(api_key)}")
-        print(f"DEBUG: API key starts with 'sk-': {api_key.startswith('sk-')}")
-        print(f"DEBUG: API key is empty: {not api_key}")
-        print(f"DEBUG: API key equals default: {api_key == 'your_openai_api_key_here'}")
+        # Key details stay at DEBUG so they never reach normal logs
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"API key length: {len(api_key)}")
+            logger.debug(f"API key starts with 'sk-': {api_key.startswith('sk-')}")
+            logger.debug(f"API key is empty: {not api_key}")
+            logger.debug(f"API key equals default: {api_key == 'your_openai_api_key_here'}")
         
         if not api_key or api_key == "your_openai_api_key_here":
             raise ValueError("OPENAI_API_KEY must be set to a valid OpenAI API key")
@@ -62,5 +76,10 @@ class Settings(BaseSettings):
         if not api_key.startswith("sk-"):
             raise ValueError("OPENAI_API_KEY must be a valid OpenAI API key starting with 'sk-'")
 
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    """Get the process-wide settings, reading the environment only once."""
+    return Settings()
+
 # Create settings instance
-settings = Settings() 
\ No newline at end of file
+settings = get_settings() 
\ No newline at end of file
@@ -0,0 +1,59 @@
+"""
+Client-side request pacing for OpenAI API limits.
+"""
+
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class TokenBucketLimiter:
+    """Thread-safe token bucket enforcing requests-per-minute and tokens-per-minute limits."""
+    
+    def __init__(self, rpm: int, tpm: int):
+        """Initialize the limiter with full buckets for the given per-minute limits."""
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._updated_at = time.monotonic()
+        self._condition = threading.Condition()
+    
+    def _refill(self):
+        """Add the capacity regained since the last update (caller holds the lock)."""
+        now = time.monotonic()
+        elapsed = now - self._updated_at
+        self._updated_at = now
+        self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+    
+    def acquire(self, tokens: int):
+        """
+        Block until one request using the given number of tokens fits within both limits.
+        
+        Args:
+            tokens: Estimated tokens the request will consume
+        """
+        # A request larger than the whole bucket can only wait for a full bucket
+        tokens = min(tokens, self.tpm)
+        
+        with self._condition:
+            waited = 0.0
+            while True:
+                self._refill()
+                if self._requests >= 1 and self._tokens >= tokens:
+                    self._requests -= 1
+                    self._tokens -= tokens
+                    break
+                
+                # Sleep until the scarcer of the two buckets has enough capacity
+                delay = max(
+                    (1 - self._requests) * 60 / self.rpm,
+                    (tokens - self._tokens) * 60 / self.tpm
+                )
+                waited += delay
+                self._condition.wait(delay)
+        
+        if waited:
+            logger.debug(f"Rate limiter delayed request of {tokens} tokens by {waited:.2f}s")
@@ -0,0 +1,52 @@
+"""
+File-backed state shared between worker processes.
+"""
+
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+class SharedState:
+    """Small JSON document that lets every worker process see the currently loaded PDF."""
+    
+    def __init__(self, path: str):
+        """Initialize shared state stored at the given path."""
+        self.path = Path(path)
+        self._seen_mtime_ns: Optional[int] = None
+    
+    def write(self, state: Dict[str, Any]):
+        """Atomically publish new state to all workers."""
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.path)
+        
+        # This worker already holds the state it just wrote
+        self._seen_mtime_ns = self.path.stat().st_mtime_ns
+    
+    def read_if_changed(self) -> Optional[Dict[str, Any]]:
+        """
+        Read the state if another worker has published a new version.
+        
+        Returns:
+            The new state, or None if it is missing or unchanged since the last read/write
+        """
+        try:
+            mtime_ns = self.path.stat().st_mtime_ns
+            if mtime_ns == self._seen_mtime_ns:
+                return None
+            
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            self._seen_mtime_ns = mtime_ns
+            return state
+        
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Error reading shared state: {str(e)}")
+            return None
@@ -0,0 +1,93 @@
+"""
+Shared tiktoken encoder and cached token counting used by all services.
+"""
+
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import tiktoken
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of distinct texts, and their total characters, whose token counts are cached
+_TOKEN_CACHE_SIZE = 65536
+_TOKEN_CACHE_MAX_CHARS = 16 * 1024 * 1024
+
+# Threads tiktoken spawns per batched encode call (tiktoken's default is 8)
+_encode_threads = 8
+
+# Shared encoder, loaded once per process on first use
+_tokenizer: Optional[tiktoken.Encoding] = None
+_tokenizer_loaded = False
+_tokenizer_lock = threading.Lock()
+
+# LRU cache of token counts; repeated headers, footers and boilerplate are encoded once
+_token_cache: "OrderedDict[str, int]" = OrderedDict()
+_token_cache_chars = 0
+_token_cache_lock = threading.Lock()
+
+def get_tokenizer() -> Optional[tiktoken.Encoding]:
+    """Get the shared GPT-4 (cl100k_base) tokenizer, or None if it cannot be loaded."""
+    global _tokenizer, _tokenizer_loaded
+    if not _tokenizer_loaded:
+        with _tokenizer_lock:
+            if not _tokenizer_loaded:
+                try:
+                    _tokenizer = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    logger.warning(f"Could not load tiktoken encoding, estimating token counts: {str(e)}")
+                    _tokenizer = None
+                _tokenizer_loaded = True
+    return _tokenizer
+
+def set_encode_threads(num_threads: int):
+    """Set how many threads each batched encode uses (1 inside already-parallel worker processes)."""
+    global _encode_threads
+    _encode_threads = num_threads
+
+def count_tokens(text: str) -> int:
+    """Count tokens in text using tiktoken."""
+    return count_tokens_batch([text])[0]
+
+def count_tokens_uncached(texts: List[str]) -> List[int]:
+    """Count tokens for one-off texts (e.g. per-request prompts) without filling the cache."""
+    tokenizer = get_tokenizer()
+    if tokenizer:
+        # encode_ordinary_batch just maps encode_ordinary over a new thread pool per call, so it
+        # only pays off for several texts with more than one thread
+        if _encode_threads == 1 or len(texts) == 1:
+            return [len(tokenizer.encode_ordinary(text)) for text in texts]
+        return [len(tokens) for tokens in tokenizer.encode_ordinary_batch(texts, num_threads=_encode_threads)]
+    # Fallback: rough estimate (1 token ≈ 4 characters)
+    return [len(text) // 4 for text in texts]
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    """Count tokens for many texts, encoding only uncached ones in a single batched call."""
+    global _token_cache_chars
+    with _token_cache_lock:
+        counts = [_token_cache.get(text) for text in texts]
+        for text, count in zip(texts, counts):
+            if count is not None:
+                _token_cache.move_to_end(text)
+    
+    missing = list(dict.fromkeys(text for text, count in zip(texts, counts) if count is None))
+    if not missing:
+        return counts
+    
+    computed = dict(zip(missing, count_tokens_uncached(missing)))
+    
+    with _token_cache_lock:
+        for text, count in computed.items():
+            if text not in _token_cache:
+                _token_cache_chars += len(text)
+            _token_cache[text] = count
+        
+        # Bound both entry count and memory (entries can be multi-KB strings)
+        while _token_cache and (len(_token_cache) > _TOKEN_CACHE_SIZE
+                                or _token_cache_chars > _TOKEN_CACHE_MAX_CHARS):
+            text, _ = _token_cache.popitem(last=False)
+            _token_cache_chars -= len(text)
+    
+    return [computed[text] if count is None else count for text, count in zip(texts, counts)]
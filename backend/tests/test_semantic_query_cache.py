@@ -0,0 +1,41 @@
+"""
+Tests for the semantic query cache used by the RAG service.
+"""
+
+import numpy as np
+import pytest
+
+rag_service = pytest.importorskip("app.services.rag_service")
+
+class FakeClock:
+    """Controllable replacement for time.monotonic."""
+    
+    def __init__(self):
+        self.now = 0.0
+    
+    def __call__(self) -> float:
+        return self.now
+
+def _unit(values):
+    vector = np.asarray(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def test_hit_does_not_extend_entry_lifetime(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(rag_service.time, "monotonic", clock)
+    cache = rag_service.SemanticQueryCache(ttl_seconds=600)
+    query_a = _unit([1.0, 0.0])
+    query_b = _unit([0.0, 1.0])
+    
+    cache.put(query_a, "report.pdf", 5, [{"content": "a"}])
+    clock.now = 100
+    cache.put(query_b, "report.pdf", 5, [{"content": "b"}])
+    
+    # The hit moves A behind B in LRU order
+    clock.now = 500
+    assert cache.get(query_a, "report.pdf", 5) == [{"content": "a"}]
+    
+    # A was stored at t=0 and must expire at t=600 even though B is still fresh
+    clock.now = 650
+    assert cache.get(query_a, "report.pdf", 5) is None
+    assert cache.get(query_b, "report.pdf", 5) == [{"content": "b"}]